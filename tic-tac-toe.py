@@ -4,9 +4,149 @@ Generate all possible tic-tac-toe board states, and write them out to (linked) h
 
 Determine optimal play for second player ("O") and suggest moves accordingly.
 """
-from collections import defaultdict, OrderedDict
+import os
+from array import array
+from collections import defaultdict
+from functools import cached_property
+
+# Boards are stored as a pair of 9-bit masks, one per player, where bit `i`
+# is set if that player has a mark on spot `i`.
+LINES = (0b000000111, 0b000111000, 0b111000000,  # rows
+         0o111, 0o111 << 1, 0o111 << 2,          # columns
+         0b100010001, 0b001010100)               # diagonals
+FULL = 0b111111111
+
+# All 8 lines packed into 10-bit slots of a single int (9 bits of line plus a
+# guard bit), so a mask can be tested against every line at once
+SLOT_ONES = sum(1 << (10 * k) for k in range(len(LINES)))
+SLOT_GUARDS = SLOT_ONES << 9
+PACKED_LINES = sum(line << (10 * k) for k, line in enumerate(LINES))
+
+# Base-3 weight of every 9-bit mask, so that a board's ternary code
+# (0 = empty, 1 = X, 2 = O per spot) is TERNARY[x_mask] + 2 * TERNARY[o_mask]
+TERNARY = array('H', [sum(3 ** i for i in range(9) if m >> i & 1) for m in range(512)])
+
+STATUSES = ("play", "win", "loss", "tie")
+
+# Text of every 3-spot row, indexed by [x_row][o_row] for the row's 3-bit masks
+ROW_STRS = tuple(tuple("".join(['X' if x >> i & 1 else 'O' if o >> i & 1 else '_'
+                                for i in range(3)])
+                       for o in range(8))
+                 for x in range(8))
+
+# Symmetries of the board as index permutations: spot `v` of the permuted
+# board is spot `p[v]` of the original
+IDENTITY = tuple(range(9))
+CW = (6, 3, 0, 7, 4, 1, 8, 5, 2)
+MIRROR = (2, 1, 0, 5, 4, 3, 8, 7, 6)
+
+def make_syms():
+    """
+    The 8 symmetries of the square: 4 rotations, each with and without a mirror
+
+    >>> len(set(make_syms()))
+    8
+    """
+    syms = []
+    p = IDENTITY
+    for _ in range(4):
+        syms.append(p)
+        syms.append(tuple(p[m] for m in MIRROR))
+        p = tuple(p[c] for c in CW)
+    return tuple(syms)
+
+SYMS = make_syms()
+
+def permute(mask: int, p: tuple):
+    """
+    >>> bin(permute(0b000000001, CW))
+    '0b100'
+    """
+    return sum(((mask >> src) & 1) << dst for dst, src in enumerate(p))
+
+# Every symmetry applied to every possible 9-bit mask, so that permuting a
+# mask is a single lookup
+SYM_LUTS = tuple(array('H', [permute(m, p) for m in range(512)]) for p in SYMS)
+ROT_LUT = SYM_LUTS[2] # make_syms lists the single clockwise turn third
+
+def rotate_mask(mask: int):
+    """
+    >>> bin(rotate_mask(0b000000001))
+    '0b100'
+    """
+    return ROT_LUT[mask]
+
+def canonical_key(x_mask: int, o_mask: int):
+    """
+    Smallest (x_mask, o_mask) among all the symmetric versions of a board
+
+    >>> canonical_key(0b000000100, 0) == canonical_key(0b100000000, 0)
+    True
+    """
+    return min((lut[x_mask], lut[o_mask]) for lut in SYM_LUTS)
+
+def ternary_index(x_mask: int, o_mask: int):
+    """
+    >>> ternary_index(0b000000001, 0b000000100)
+    19
+    """
+    return TERNARY[x_mask] + 2 * TERNARY[o_mask]
+
+def has_line(mask: int):
+    """
+    Does `mask` cover any of the 8 lines?
+
+    Copies the mask into every slot and clears the bits each slot's line has,
+    leaving a slot at 0 exactly when its line is full. Setting the guard bits
+    and subtracting 1 from every slot then clears the guard of any zero slot.
+
+    >>> has_line(0b001010100)
+    True
+    >>> has_line(0b110001011)
+    False
+    """
+    missing = (mask * SLOT_ONES & PACKED_LINES) ^ PACKED_LINES
+    return ((missing | SLOT_GUARDS) - SLOT_ONES) & SLOT_GUARDS != SLOT_GUARDS
+
+def status_from_masks(x_mask: int, o_mask: int):
+    """
+    Index into STATUSES for the board, from X's point of view
+    """
+    if has_line(x_mask):
+        return 1
+    if has_line(o_mask):
+        return 2
+    if (x_mask | o_mask) == FULL:
+        return 3
+    return 0
+
+# (spot, bit) of every empty spot, indexed by the mask of occupied spots
+EMPTY_SPOTS = tuple(tuple((i, 1 << i) for i in range(9) if not occupied >> i & 1)
+                    for occupied in range(512))
+
+def children_masks(x_mask: int, o_mask: int, is_x_turn: bool):
+    """
+    (move, x_mask, o_mask) for each empty spot, taken by the player to move
+
+    >>> for i, x, o in children_masks(0b010001101, 0b000110010, False): print(i, State.to_str(x, o))
+    6 XOXXOOOX_
+    8 XOXXOO_XO
+    """
+    empty = EMPTY_SPOTS[x_mask | o_mask]
+    if is_x_turn:
+        return [(i, x_mask | bit, o_mask) for i, bit in empty]
+    return [(i, x_mask, o_mask | bit) for i, bit in empty]
+
+# Status of every board, indexed by `ternary_index`. Entries are filled in the
+# first time a board is checked, since only the reachable few thousand of the
+# 3^9 boards ever are.
+UNKNOWN = -1
+STATUS_TABLE = array('b', [UNKNOWN]) * 3 ** 9
 
 class State:
+    # Shared instances handed out by `State.get`, keyed by (x_mask, o_mask)
+    _STATE_CACHE = {}
+
     def __init__(self, s: str = ""):
         """
         Create a tic-tac-toe board state
@@ -52,6 +192,16 @@ class State:
         >>> State('XXOXXOOOX').depth
         9
 
+        >>> State("X_O").str
+        'X_O______'
+
+        """
+        self._init_common(*State._parse(s))
+
+    @staticmethod
+    def _parse(s: str):
+        """
+        Validate a board string and return its (x_mask, o_mask)
         """
         if len(s) > 9:
             raise ValueError("too many moves")
@@ -62,14 +212,44 @@ class State:
         move_differences = x_moves - o_moves
         if move_differences > 1 or move_differences < 0:
             raise ValueError("illegal board state")
-        self.s = dict(enumerate(s.ljust(9,"_")))
-        self.str = State.to_str(self.s)
-        self.depth = 9 - self.str.count('_')
-        self.board = self.to_board()
+        x_mask = sum(1 << i for i, c in enumerate(s) if c == 'X')
+        o_mask = sum(1 << i for i, c in enumerate(s) if c == 'O')
+        return x_mask, o_mask
+
+    def _init_common(self, x_mask: int, o_mask: int):
+        self.x_mask = x_mask
+        self.o_mask = o_mask
+        self.str = State.to_str(x_mask, o_mask)
+        self.depth = (x_mask | o_mask).bit_count()
         self.status = self.check_status()
-        self.player = 'X' if x_moves == o_moves else 'O'
+        self.player = 'X' if self.depth % 2 == 0 else 'O'
         self.set_default_value()
 
+    @classmethod
+    def _from_trusted(cls, x_mask: int, o_mask: int):
+        """
+        Shared state for masks that are already known to be a legal board
+
+        >>> State._from_trusted(0b000000001, 0) is State.get("X")
+        True
+        """
+        state = cls._STATE_CACHE.get((x_mask, o_mask))
+        if state is None:
+            state = cls.__new__(cls)
+            state._init_common(x_mask, o_mask)
+            cls._STATE_CACHE[(x_mask, o_mask)] = state
+        return state
+
+    @classmethod
+    def get(cls, s: str = ""):
+        """
+        Like `State(s)`, but returns the same instance every time for a given board
+
+        >>> State.get("X") is State.get("X________")
+        True
+        """
+        return cls._from_trusted(*cls._parse(s))
+
     def set_default_value(self):
         if self.status == 'tie':
             self.value = 0
@@ -82,25 +262,49 @@ class State:
         else:
             self.value = 999
 
+    @cached_property
+    def board(self):
+        """
+        Only built when a board is printed or rotated; the tree never needs it
+
+        >>> State("X_O").board
+        ('X', '_', 'O', '_', '_', '_', '_', '_', '_')
+        """
+        return self.to_board()
+
     def to_board(self):
-        out = [["_" for j in range(3)] for i in range(3)]
-        for v in range(9):
-           i = v % 3
-           j = v // 3
-           out[j][i] = self.s[v]
-        return out
+        """
+        The 9 spots in order, row by row
+
+        >>> State("X_O").to_board()
+        ('X', '_', 'O', '_', '_', '_', '_', '_', '_')
+        """
+        return tuple(self.str)
 
     @staticmethod
-    def to_str(d: dict):
+    def to_str(x_mask: int, o_mask: int):
         """
-        >>> State.to_str(State("X_O").s)
+        >>> State.to_str(0b000000001, 0b000000100)
         'X_O______'
         """
-        return "".join([d[i] for i in range(9)])
+        return (ROW_STRS[x_mask & 7][o_mask & 7]
+                + ROW_STRS[x_mask >> 3 & 7][o_mask >> 3 & 7]
+                + ROW_STRS[x_mask >> 6][o_mask >> 6])
+
+    def canonical(self):
+        """
+        String of the board that stands in for all of its rotations and reflections
+
+        >>> State("__X").canonical() == State("______X").canonical()
+        True
+        >>> State("X").canonical() == State("_X").canonical()
+        False
+        """
+        return State.to_str(*canonical_key(self.x_mask, self.o_mask))
 
     def make_children(self):
         """
-        >>> for child in State("X").make_children(): print(child)
+        >>> for move, child in State("X").make_children(): print(child)
         XO_
         ___
         ___
@@ -135,17 +339,14 @@ class State:
         <BLANKLINE>
 
         This should be empty, since it's a leaf node (X wins)
-        >>> for child in State("XXXOO_O").make_children(): print(child)
+        >>> for move, child in State("XXXOO_O").make_children(): print(child)
         """
         # leaf node
         if self.status != "play":
             return()
 
-        for i in range(9):
-            if self.s[i] == '_':
-                ss = self.s.copy()
-                ss[i] = self.player
-                yield (i, State(State.to_str(ss)))
+        for i, x_mask, o_mask in children_masks(self.x_mask, self.o_mask, self.player == 'X'):
+            yield (i, State._from_trusted(x_mask, o_mask))
 
     def __str__(self):
         """
@@ -166,7 +367,7 @@ class State:
         <BLANKLINE>
         """
 
-        return("\n".join(["".join(row) for row in self.board]) + "\n")
+        return("\n".join(["".join(self.board[j:j + 3]) for j in range(0, 9, 3)]) + "\n")
 
     @staticmethod
     def board_to_s(board):
@@ -174,7 +375,7 @@ class State:
         >>> State.board_to_s(State("X").board)
         'X________'
         """
-        return("".join(["".join(row) for row in board]))
+        return("".join(board))
 
     @staticmethod
     def rotate(board):
@@ -190,33 +391,28 @@ class State:
         8 5 2
 
         >>> State.rotate(State("X").board)
-        [['_', '_', 'X'], ['_', '_', '_'], ['_', '_', '_']]
+        ('_', '_', 'X', '_', '_', '_', '_', '_', '_')
 
         >>> State.rotate(State.rotate(State("X").board))
-        [['_', '_', '_'], ['_', '_', '_'], ['_', '_', 'X']]
+        ('_', '_', '_', '_', '_', '_', '_', '_', 'X')
         """
-        cw = {0:6, 1:3, 2:0, 3:7, 4:4, 5:1, 6:8, 7:5, 8:2}
-        local_s = State.board_to_s(board)
-        out = [["_" for j in range(3)] for i in range(3)]
-        for v in range(9):
-           i = v % 3
-           j = v // 3
-           out[j][i] = local_s[cw[v]]
-        return out
+        return tuple([board[src] for src in CW])
 
     def rotations(self):
         """
-        >>> for r in State("X_O").rotations(): print(r)
-        [['X', '_', 'O'], ['_', '_', '_'], ['_', '_', '_']]
-        [['_', '_', 'X'], ['_', '_', '_'], ['_', '_', 'O']]
-        [['_', '_', '_'], ['_', '_', '_'], ['O', '_', 'X']]
-        [['O', '_', '_'], ['_', '_', '_'], ['X', '_', '_']]
+        (x_mask, o_mask) for each of the 4 rotations of the board
+
+        >>> for x, o in State("X_O").rotations(): print(State.to_str(x, o))
+        X_O______
+        __X_____O
+        ______O_X
+        O_____X__
         """
-        r = self.board
-        yield(r)
+        x, o = self.x_mask, self.o_mask
+        yield(x, o)
         for i in range(3):
-            r = State.rotate(r)
-            yield(r)
+            x, o = rotate_mask(x), rotate_mask(o)
+            yield(x, o)
 
     def check_status(self):
         """
@@ -254,84 +450,204 @@ class State:
         >>> State("XOXXXOOXO").check_status()
         'tie'
         """
-        for r in self.rotations():
-            if r[0] == ['X','X','X']:
-                return "win"
-            elif r[0] == ['O','O','O']:
-                return "loss"
-            elif r[1] == ['X', 'X', 'X']:
-                return "win"
-            elif r[1] == ['O', 'O', 'O']:
-                return "loss"
-            elif r[0][0] == "X" and r[1][1] == "X" and r[2][2] == "X":
-                return "win"
-            elif r[0][0] == "O" and r[1][1] == "O" and r[2][2] == "O":
-                return "loss"
-        if self.str.count('_') == 0:
-            return 'tie'
-        else:
-            return "play"
+        i = ternary_index(self.x_mask, self.o_mask)
+        status = STATUS_TABLE[i]
+        if status == UNKNOWN:
+            status = STATUS_TABLE[i] = status_from_masks(self.x_mask, self.o_mask)
+        return STATUSES[status]
 
-def make_tree():
+def make_tree(canonical: bool = False):
     """
     Create the tree of all games
 
     Returns `nodes` which has all of the node data, plus `leaves`
     which covers all of the final leaves, `children` which is a tuple
-    of (move, state), and `parents` which is self-explanatory.
-
-    Everything keys off of the string.
+    of (move, state), `parents` which is self-explanatory, and `layers`
+    which lists the nodes at each depth.
+
+    Everything keys off of the string. With `canonical`, boards that are
+    rotations or reflections of each other share a single node, keyed (and
+    stored) by `State.canonical`; moves are spots on that stored board.
+
+    >>> len(make_tree()['nodes'])
+    5478
+    >>> len(make_tree(canonical=True)['nodes'])
+    765
+    >>> [len(layer) for layer in make_tree()['layers']]
+    [1, 9, 72, 252, 756, 1260, 1520, 1140, 390, 78]
     """
-    nodes = {"_________": State()}
+    nodes = {"_________": State.get()}
     parents = defaultdict(list)
     children = defaultdict(list)
     leaves = set()
 
-    visited = set()
-    to_visit = nodes.keys() - visited
-    while len(to_visit) > 0:
-        node_key = to_visit.pop()
-        node = nodes[node_key]
-        visited.add(node_key)
-        i = 0
-        for move, child in node.make_children():
-            s = child.str
-            parents[s].append(node_key)
-            children[node_key].append((move, s))
-            nodes[s] = child
-            i += 1
-        if i == 0: # no children; win/loss/tie node
-            leaves.add(node_key)
-        to_visit = nodes.keys() - visited
+    # Every move adds one mark, so expand a whole depth at a time: each
+    # layer's children are exactly the next layer
+    layers = [list(nodes)]
+    while len(layers[-1]) > 0:
+        frontier = []
+        for node_key in layers[-1]:
+            i = 0
+            for move, child in nodes[node_key].make_children():
+                s = child.canonical() if canonical else child.str
+                parents[s].append(node_key)
+                children[node_key].append((move, s))
+                if s not in nodes:
+                    nodes[s] = State.get(s) if canonical else child
+                    frontier.append(s)
+                i += 1
+            if i == 0: # no children; win/loss/tie node
+                leaves.add(node_key)
+        layers.append(frontier)
+    layers.pop() # the last frontier is always empty
 
     return({"nodes": nodes,
             "parents": parents,
             "children": children,
-            "leaves": leaves})
+            "leaves": leaves,
+            "layers": layers})
 
-def minimax(nodes: dict, children: dict, leaves: set, parents: dict):
+def minimax(nodes: dict, children: dict, leaves: set, parents: dict, layers: list = None):
     """
     Start from the end, work backwards to recusively identify the right moves for each player
 
     See https://www.neverstopbuilding.com/blog/minimax for good discussion of minimax strategy,
     and https://www.youtube.com/watch?v=STjW3eH0Cik for a good MIT OCW video on it.
 
+    Every child is one move deeper than its parent, so sweeping the `layers` of
+    `make_tree` from the deepest up means all of a node's children are final by
+    the time it is scored, and each node is scored exactly once. Without `layers`
+    the nodes are grouped by depth here.
+
+    >>> tree = make_tree()
+    >>> minimax(tree['nodes'], tree['children'], tree['leaves'], tree['parents'], tree['layers'])
+    >>> tree['nodes']['_________'].value
+    0
+    >>> tree['nodes']['XO_______'].value
+    3
+
+    >>> tree = make_tree(canonical=True)
+    >>> minimax(tree['nodes'], tree['children'], tree['leaves'], tree['parents'])
+    >>> tree['nodes']['_________'].value
+    0
+    """
+    if layers is None:
+        layers = [[k for k, n in nodes.items() if n.depth == depth] for depth in range(10)]
+    for layer in reversed(layers):
+        for node_key in layer:
+            if node_key in leaves:
+                continue
+            node = nodes[node_key]
+            if node.player == 'X':
+                node.value = max([nodes[c[1]].value for c in children[node_key]])
+            else: # minimize
+                node.value = min([nodes[c[1]].value for c in children[node_key]])
+
+# Solved boards, one byte per base-3 board code: the low 4 bits are the
+# minimax value plus VALUE_OFFSET (values run from -4 to 5), the high 4 bits
+# the best move for the player to go, or NO_MOVE once the game is over.
+# Boards that can't come up in a game are UNREACHABLE.
+LUT_PATH = "minimax.bin"
+VALUE_OFFSET = 8
+NO_MOVE = 0xF
+UNREACHABLE = 0xFF
+
+def write_lut(nodes: dict, children: dict, path: str = LUT_PATH):
     """
-    to_visit = OrderedDict()
-    for leaf in leaves:
-        for p in parents[leaf]:
-            to_visit[p] = None
-
-    while len(to_visit) > 0:
-        node_key = to_visit.popitem(last=False)[0] # FIFO
-        node = nodes[node_key]
-        if node.player == 'X':
-            node.value = max([nodes[c[1]].value for c in children[node_key]])
-        else: # minimize
-            node.value = min([nodes[c[1]].value for c in children[node_key]])
-
-        for p in parents[node_key]:
-            to_visit[p] = None
+    Save the minimax value and best move of every board to `path`
+
+    `nodes` has to be the full (not canonical) tree, already run through `minimax`.
+    """
+    lut = bytearray([UNREACHABLE]) * 3 ** 9
+    for node_key, node in nodes.items():
+        move = NO_MOVE
+        best = None
+        for m, c in children.get(node_key, []):
+            value = nodes[c].value
+            if best is None or (value > best if node.player == 'X' else value < best):
+                move, best = m, value
+        lut[ternary_index(node.x_mask, node.o_mask)] = move << 4 | (node.value + VALUE_OFFSET)
+    # write next to `path` and swap it in, so an interrupted run can't leave
+    # a partial table behind
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(lut)
+    os.replace(tmp_path, path)
+
+def load_lut(path: str = LUT_PATH):
+    """
+    Read a table written by `write_lut`, or None if `path` doesn't hold one
+
+    >>> load_lut(os.devnull) is None
+    True
+    """
+    try:
+        if os.path.getsize(path) != 3 ** 9:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def lookup(lut, state: State):
+    """
+    (value, best move) for `state`, or None if it can't come up in a game
+
+    >>> import tempfile
+    >>> tree = make_tree()
+    >>> minimax(tree['nodes'], tree['children'], tree['leaves'], tree['parents'], tree['layers'])
+    >>> with tempfile.TemporaryDirectory() as tmp:
+    ...     path = os.path.join(tmp, LUT_PATH)
+    ...     write_lut(tree['nodes'], tree['children'], path)
+    ...     lut = load_lut(path)
+    >>> lookup(lut, State())
+    (0, 0)
+    >>> lookup(lut, State("XO"))
+    (3, 3)
+    >>> lookup(lut, State("XXXOO"))
+    (5, None)
+
+    X won before O's last move, so this board is never reached
+    >>> lookup(lut, State("XXXOO_O")) is None
+    True
+    """
+    entry = lut[ternary_index(state.x_mask, state.o_mask)]
+    if entry == UNREACHABLE:
+        return None
+    move = entry >> 4
+    return (entry & 0xF) - VALUE_OFFSET, None if move == NO_MOVE else move
+
+HTML_PREFIX = ("<!DOCTYPE html><html><body>\n"
+               """<style>
+            div {font-family: monospace; width: 20%; margin: auto;
+            padding: 10em; font-size: 200%;}
+            a:link { text-decoration: none!important; }
+            </style>\n"""
+               "<div>")
+HTML_SUFFIX = "</div></body></html>"
+HTML_RESTART = "</br></br><a href='index.html'>(♻️  Start again?)</a>"
+HTML_RESULTS = {"win": "</br></br>X wins!", "loss": "</br></br>O wins!"}
+
+def make_html(node: State, cs: dict):
+    """
+    Page for one game state, where `cs` maps each open spot to the next state
+
+    >>> print(make_html(State("XXXOO"), {}).split("<div>")[1])
+    X|X|X</br>
+    O|O|_</br>
+    _|_|_</br>
+    </br></br><a href='index.html'>(♻️  Start again?)</a></br></br>X wins!</div></body></html>
+    """
+    s = node.str
+    parts = [HTML_PREFIX]
+    for i in range(9):
+        v = cs.get(i)
+        parts.append(s[i] if v is None else f'<a href="{v}.html">_</a>')
+        parts.append("</br>\n" if i % 3 == 2 else "|")
+    parts.append(HTML_RESTART)
+    parts.append(HTML_RESULTS.get(node.status, ""))
+    parts.append(HTML_SUFFIX)
+    return "".join(parts)
 
 def make_htmls(nodes: dict, children: dict):
     """
@@ -341,30 +657,7 @@ def make_htmls(nodes: dict, children: dict):
     TODO be able to switch between two-human and one-human mode
     """
     for node_str, node in nodes.items():
-        cs = dict(children.get(node_str, []))
-        out = "<!DOCTYPE html><html><body>\n"
-        out += """<style>
-            div {font-family: monospace; width: 20%; margin: auto;
-            padding: 10em; font-size: 200%;}
-            a:link { text-decoration: none!important; }
-            </style>\n"""
-        out += "<div>"
-        for i in range(9):
-            n = node.s[i]
-            v = cs.get(i)
-            if v == None:
-                out += f'{n}|'
-            else:
-                out += f'<a href="{v}.html">_</a>|'
-            if ((i+1) % 3 == 0):
-                out = out[:-1] + "</br>\n"
-
-        out += "</br></br><a href='index.html'>(♻️  Start again?)</a>"
-        if node.status == 'win':
-            out += "</br></br>X wins!"
-        elif node.status == 'loss':
-            out += "</br></br>O wins!"
-        out += "</div></body></html>"
+        out = make_html(node, dict(children.get(node_str, [])))
         if node_str == "_________":
             node_str = "index"
         with open(f'out/{node_str}.html', 'wt') as f:
@@ -376,8 +669,9 @@ def main():
     parents = res['parents']
     children = res['children']
     leaves = res['leaves']
+    layers = res['layers']
 
-    minimax(nodes, children, leaves, parents)
+    minimax(nodes, children, leaves, parents, layers)
 
     make_htmls(nodes, children)
 